@@ -1,7 +1,18 @@
 #ターザンロープアクションゲーム
 
+import argparse
+import bisect
+import collections
+import json
 import math
+import os
+import queue
 import random
+import shlex
+import struct
+import subprocess
+import threading
+import time
 import pygame
 
 #ゲームバランスを調整するとき用の定数を定義
@@ -11,6 +22,24 @@ GOAL_X = 15000        #ゴール地点のX座標
 TIME_LIMIT = 60        #制限時間（秒）
 GRAVITY = 0.08         #重力（小さめでふわっと）
 AIR_DRAG = 0.94        #空気抵抗（1.0に近いほど減速しない）
+SENSOR_RAYS = 32       #センサーのレイの本数
+SENSOR_SPREAD = 120    #レイを広げる角度（ROPE_ANGLEを中心に左右へ半分ずつ）
+SENSOR_RANGE = 600     #センサーの最大距離
+REWIND_MEMORY_KB = 1024    #巻き戻し用スナップショットに使うメモリ（KB）
+REWIND_SECONDS = 3         #Rキーで巻き戻す秒数
+SNAPSHOT_MAX_EFFECTS = 32  #スナップショットに残すエフェクトの最大数
+SNAPSHOT_MAX_HAZARDS = 1024  #スナップショットで生き残りを記録する落石・アイテムの最大数
+SNAPSHOT_MAX_FALLING = 16    #スナップショットに残す落下中の岩の最大数
+SNAPSHOT_MAX_RNG_STATES = 32 #巻き戻し用に残す乱数の状態の数（REWIND_MEMORY_KBに含む）
+CAPTURE_POOL_SIZE = 8      #録画用に使い回すフレームバッファの数（足りないときはフレームを捨てる）
+COLLISION_CELL = 128       #当たり判定用の空間ハッシュのセルの大きさ
+ROCK_CHANCE = 0.5          #天井ブロックの下に岩を置く確率
+ROCK_GRAVITY = 0.3         #落石の重力
+ROCK_TRIGGER_DIST = 250    #プレイヤーがこの距離まで近づいたら岩が落ち始める
+PICKUP_CHANCE = 0.5        #天井の隙間にアイテムを置く確率
+PICKUP_TIME_BONUS = 3      #アイテムで増える残り時間（秒）
+TRAIL_LENGTH = 48          #プレイヤーの軌跡に残す位置の数（0で表示しない）
+TRAIL_FADE_STEPS = 8       #軌跡を何段階で薄くするか
 
 #クラス定義
 class World:
@@ -57,8 +86,8 @@ class Particle:
         if self.vel.length() > 10:
             self.vel.scale_to_length(10)
 
-        #ふわっとした操作感のための軽い空気抵抗
-        self.vel *= AIR_DRAG
+        #ふわっとした操作感のための軽い空気抵抗（1フレームを分割したときも同じ減り方にする）
+        self.vel *= AIR_DRAG ** self.world.dt
 
         #位置更新
         self.pos += self.vel * self.world.dt
@@ -96,6 +125,94 @@ class Spark:
         pygame.draw.circle(screen, self.color, (draw_x, draw_y), self.size)
 
 
+class MotionTrail:
+    """ プレイヤーの軌跡。最初に確保したリングバッファに位置をためて描く
+    軌跡をsteps個の区間に分け、描き終わった区間はその大きさぴったりの小さなSurfaceに一度だけ描いておく
+    （chunk回のpushに1枚作り直す。大きいSurfaceを確保して使い回すと、描き直しと貼るのが遅くなるのでこうしている）
+    毎フレームは、区間ごとの透明度を変えてまとめて貼るのと、最新の区間の折れ線1本だけ
+    """
+    KEY = (255, 0, 255)     #透明にする色
+
+    def __init__(self, length=TRAIL_LENGTH, color=(255, 240, 200), width=6, steps=TRAIL_FADE_STEPS):
+        self.length = max(0, length)
+        self.color = color
+        self.width = width
+        self.steps = max(1, min(steps, self.length // 2))
+        self.chunk = max(1, self.length // self.steps)     #1区間の点の数
+        self.size = self.length + 1     #区間のつなぎ目の点も残せるように1つ多く取る
+        self.xs = [0.0] * self.size
+        self.ys = [0.0] * self.size
+
+        #古い区間ほど薄くする透明度（古い方から順）
+        self.alphas = [255 * (i + 1) // (self.steps + 1) for i in range(self.steps)]
+        #区間ごとに描いておくSurface [Surface, 左上のワールド座標x, y, 今の透明度]
+        self.strips = [None] * self.steps
+        self.clear()
+
+    def clear(self):
+        self.head = 0       #次に書き込む場所
+        self.count = 0
+        self.total = 0      #今までにためた点の数（区間の番号を決めるのに使う）
+
+    def _points(self, first, last):
+        """通し番号first〜lastの点をリングバッファから取り出す"""
+        return [(self.xs[i % self.size], self.ys[i % self.size]) for i in range(first, last + 1)]
+
+    def push(self, x, y):
+        if self.length < 2:
+            return      #2点ないと線にならないので、何もためない
+        self.xs[self.head] = x
+        self.ys[self.head] = y
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.length)
+        self.total += 1
+        #区間がちょうど埋まったら、その区間を1回だけSurfaceに描いておく
+        if self.total % self.chunk == 0 and self.total > self.chunk:
+            self._render_chunk(self.total // self.chunk - 1)
+
+    def _render_chunk(self, k):
+        points = self._points(k * self.chunk - 1, (k + 1) * self.chunk - 1)
+        pad = self.width
+        left = min(x for x, _ in points) - pad
+        top = min(y for _, y in points) - pad
+        w = int(max(x for x, _ in points) - left) + pad + 1
+        h = int(max(y for _, y in points) - top) + pad + 1
+
+        #区間の大きさぴったりのSurfaceにする（RLEにしておくと透明部分の多いSurfaceを速く貼れる）
+        surface = pygame.Surface((w, h))
+        surface.fill(self.KEY)
+        pygame.draw.lines(surface, self.color, False, [(x - left, y - top) for x, y in points], self.width)
+        surface.set_colorkey(self.KEY, pygame.RLEACCEL)
+        self.strips[k % self.steps] = [surface, left, top, None]
+
+    def draw(self, screen, scroll_x):
+        if self.count < 2:
+            return
+        oldest = self.total - self.count
+        done = self.total // self.chunk     #描き終わった区間の数
+
+        #描き終わった区間を、新しいものほど濃くしてまとめて貼る（軌跡からはみ出した区間は出さない）
+        blits = []
+        for age in range(min(self.steps, done - 1)):
+            k = done - 1 - age
+            if k * self.chunk < oldest:
+                break
+            strip = self.strips[k % self.steps]
+            alpha = self.alphas[self.steps - 1 - age]
+            if strip[3] != alpha:
+                strip[0].set_alpha(alpha, pygame.RLEACCEL)
+                strip[3] = alpha
+            blits.append((strip[0], (strip[1] - scroll_x, strip[2])))
+        if blits:
+            screen.blits(blits, doreturn=False)
+
+        #まだ埋まっていない最新の区間は、そのまま折れ線で描く
+        first = max(done * self.chunk - 1, oldest)
+        if self.total - 1 > first:
+            points = [(x - scroll_x, y) for x, y in self._points(first, self.total - 1)]
+            pygame.draw.lines(screen, self.color, False, points, self.width)
+
+
 class Rope:
     """ ロープ"""
     def __init__(self, anchor_x, anchor_y, player, world):
@@ -128,7 +245,7 @@ class Rope:
                     self.player.vel -= normal * dot
         
         # グロー効果を減速（エフェクト用）
-        self.glow_intensity *= 0.95
+        self.glow_intensity *= 0.95 ** self.world.dt
 
     def draw(self, screen, scroll_x):
         start = (int(self.anchor.x - scroll_x), int(self.anchor.y))
@@ -136,21 +253,40 @@ class Rope:
         pygame.draw.line(screen, (100, 200, 100), start, end, 3)
 
 
+def generate_course(rng=random):
+    """天井ブロックの配置を (x, 幅, 高さ) のリストで作る
+    rngに random.Random(seed) を渡すと同じコースを何度でも作れる
+    """
+    #randint(a, b)はrandrange(a, b + 1)と同じ乱数列になるので、呼び出しを1段減らしてある
+    randrange = rng.randrange
+    #スタート地点の天井を作る
+    course = [(-200, 800, 50)]
+
+    #15000px先まで天井を作る
+    current_x = 600     #最初の天井のx座標
+    while current_x < 15000:
+        w = randrange(60, 151)        #ランダムに天井の幅を決める（60〜150）
+        h = randrange(50, 201)         #ランダムに天井の高さを決める（50〜200）
+        course.append((current_x, w, h))
+        current_x += w + randrange(250, 701) #天井と天井の間の隙間を作る（250〜700）
+    return course
+
+
 class CeilingMap:
     """ 天井マップ """
-    def __init__(self, world):
+    def __init__(self, world, rng=random):
         self.world = world
-        self.blocks = [] 
-        #スタート地点の天井を作る
-        self.blocks.append(pygame.Rect(-200, 0, 800, 50))
-        
-        #15000px先まで天井を作る
-        current_x = 600     #最初の天井のx座標
-        while current_x < 15000:
-            w = random.randint(60, 150)        #ランダムに天井の幅を決める
-            h = random.randint(50, 200)         #ランダムに天井の高さを決める   
-            self.blocks.append(pygame.Rect(current_x, 0, w, h))
-            current_x += w + random.randint(250, 700) #天井と天井の間の隙間を作る
+        self.blocks = [pygame.Rect(x, 0, w, h) for x, w, h in generate_course(rng)]
+
+        #ブロックはx順に並んでいるので、範囲検索用に左端と右端のリストを持っておく
+        self.lefts = [rect.left for rect in self.blocks]
+        self.rights = [rect.right for rect in self.blocks]
+
+    def blocks_between(self, x0, x1):
+        """x0〜x1の範囲に重なる天井ブロックを二分探索で取り出す"""
+        start = bisect.bisect_left(self.rights, x0)
+        end = bisect.bisect_right(self.lefts, x1)
+        return self.blocks[start:end]
 
     def get_ceiling_y(self, x):         #指定したx座標の天井のy座標を返す
         for rect in self.blocks:
@@ -208,11 +344,767 @@ class SpikeFloor:
             pygame.draw.polygon(screen, (0, 150, 0), [p1, p2, p3])
 
 
+class SpatialHash:
+    """ 一様グリッドの空間ハッシュ。物体が別のセルに移ったときだけ登録し直す """
+    def __init__(self, cell_size=COLLISION_CELL):
+        self.cell_size = cell_size
+        self.cells = {}         #(セルx, セルy) -> そのセルに重なっている物体の集合
+        self.object_cells = {}  #物体 -> 登録しているセルの範囲
+
+    def _cell_range(self, bounds):
+        left, top, right, bottom = bounds
+        size = self.cell_size
+        return (int(left // size), int(top // size), int(right // size), int(bottom // size))
+
+    def insert(self, obj, bounds):
+        cell_range = self._cell_range(bounds)
+        self.object_cells[obj] = cell_range
+        x0, y0, x1, y1 = cell_range
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                self.cells.setdefault((cx, cy), set()).add(obj)
+
+    def remove(self, obj):
+        cell_range = self.object_cells.pop(obj, None)
+        if cell_range is None:
+            return
+        x0, y0, x1, y1 = cell_range
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                cell = self.cells.get((cx, cy))
+                if cell is not None:
+                    cell.discard(obj)
+                    if not cell:
+                        del self.cells[(cx, cy)]
+
+    def update(self, obj, bounds):
+        """動いた物体の登録を更新する。セルが変わっていなければ何もしない"""
+        if self.object_cells.get(obj) == self._cell_range(bounds):
+            return
+        self.remove(obj)
+        self.insert(obj, bounds)
+
+    def query(self, bounds):
+        """boundsに重なるセルに入っている物体を返す（細かい判定はしない）"""
+        x0, y0, x1, y1 = self._cell_range(bounds)
+        found = set()
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                cell = self.cells.get((cx, cy))
+                if cell:
+                    found |= cell
+        return found
+
+
+def circle_vs_circle(center, radius, other, other_radius):
+    """円同士の当たり判定。当たっていたら (押し出す向き, めり込み量) を返す"""
+    diff = center - other
+    dist = diff.length()
+    depth = radius + other_radius - dist
+    if depth <= 0:
+        return None
+    normal = diff / dist if dist > 0 else pygame.Vector2(0, -1)
+    return normal, depth
+
+
+def circle_vs_rect(center, radius, bounds):
+    """円と長方形(left, top, right, bottom)の当たり判定。当たっていたら (押し出す向き, めり込み量) を返す"""
+    left, top, right, bottom = bounds
+    closest = pygame.Vector2(min(max(center.x, left), right), min(max(center.y, top), bottom))
+    diff = center - closest
+    dist = diff.length()
+    if dist > 0:
+        if dist >= radius:
+            return None
+        return diff / dist, radius - dist
+
+    #円の中心が長方形の中にあるときは、一番近い辺の方向に押し出す
+    exits = [(center.x - left, pygame.Vector2(-1, 0)), (right - center.x, pygame.Vector2(1, 0)),
+             (center.y - top, pygame.Vector2(0, -1)), (bottom - center.y, pygame.Vector2(0, 1))]
+    gap, normal = min(exits, key=lambda e: e[0])
+    return normal, gap + radius
+
+
+class Hazard:
+    """ 当たり判定を持つもの（落石やアイテム）の共通部分 """
+    kind = "hazard"
+    shape = "circle"
+
+    def __init__(self, index, x, y, radius=0, w=0, h=0):
+        self.index = index      #巻き戻し用の通し番号
+        self.home = pygame.Vector2(x, y)
+        self.pos = pygame.Vector2(x, y)
+        self.vel = pygame.Vector2(0, 0)
+        self.radius = radius
+        self.w = w
+        self.h = h
+        self.alive = True
+        self.falling = False
+
+    def reset(self):
+        self.pos.update(self.home)
+        self.vel.update(0, 0)
+        self.alive = True
+        self.falling = False
+
+    def bounds(self):
+        if self.shape == "circle":
+            return (self.pos.x - self.radius, self.pos.y - self.radius,
+                    self.pos.x + self.radius, self.pos.y + self.radius)
+        return (self.pos.x, self.pos.y, self.pos.x + self.w, self.pos.y + self.h)
+
+    def update(self):
+        pass
+
+    def draw(self, screen, scroll_x):
+        pass
+
+
+class FallingRock(Hazard):
+    """ 天井から落ちてくる岩 """
+    kind = "rock"
+    shape = "rect"
+
+    def update(self):
+        self.vel.y += ROCK_GRAVITY
+        self.pos += self.vel
+
+    def draw(self, screen, scroll_x):
+        draw_rect = pygame.Rect(self.pos.x - scroll_x, self.pos.y, self.w, self.h)
+        pygame.draw.rect(screen, (90, 70, 60), draw_rect)
+        pygame.draw.rect(screen, (60, 40, 30), draw_rect, 2)
+
+
+class Pickup(Hazard):
+    """ 取ると残り時間が増えるアイテム """
+    kind = "pickup"
+
+    def draw(self, screen, scroll_x):
+        center = (int(self.pos.x - scroll_x), int(self.pos.y))
+        pygame.draw.circle(screen, (255, 215, 0), center, self.radius)
+        pygame.draw.circle(screen, (255, 255, 200), center, self.radius // 2)
+
+
+class CollisionWorld:
+    """ 落石やアイテムをまとめて管理し、プレイヤーとの接触を調べる
+    毎フレームの処理は、動いているものとプレイヤーの近くのセルだけ
+    """
+    def __init__(self, world, cell_size=COLLISION_CELL):
+        self.world = world
+        self.grid = SpatialHash(cell_size)
+        self.hazards = []       #通し番号順
+        self.moving = set()     #落ちている途中の岩など、毎フレーム動かすもの
+        self.alive_bits = bytearray()   #通し番号ごとの生き残りフラグ（巻き戻し用）
+
+    @classmethod
+    def from_ceiling(cls, world, ceiling, rng=random):
+        """天井ブロックの下に岩、隙間にアイテムを置く"""
+        collision = cls(world)
+        for rect, next_rect in zip(ceiling.blocks[1:], ceiling.blocks[2:]):
+            if rng.random() < ROCK_CHANCE:
+                collision.add(FallingRock(len(collision.hazards), rect.centerx - 12, rect.bottom, w=24, h=24))
+            if rng.random() < PICKUP_CHANCE:
+                x = (rect.right + next_rect.left) / 2
+                collision.add(Pickup(len(collision.hazards), x, rng.randint(250, 450), radius=10))
+        return collision
+
+    def add(self, hazard):
+        self.hazards.append(hazard)
+        self.grid.insert(hazard, hazard.bounds())
+        if hazard.index // 8 >= len(self.alive_bits):
+            self.alive_bits.append(0)
+        self.alive_bits[hazard.index // 8] |= 1 << (hazard.index % 8)
+
+    def wake(self, hazard):
+        hazard.falling = True
+        self.moving.add(hazard)
+
+    def kill(self, hazard):
+        hazard.alive = False
+        self.grid.remove(hazard)
+        self.moving.discard(hazard)
+        self.alive_bits[hazard.index // 8] &= ~(1 << (hazard.index % 8))
+
+    def restore(self, alive_bits, falling):
+        """巻き戻し用。生き残りフラグと落下中の岩 [(通し番号, y, vy), ...] から状態を戻す"""
+        for hazard in self.hazards[:len(alive_bits) * 8]:
+            alive = alive_bits[hazard.index // 8] >> (hazard.index % 8) & 1
+            if alive and (hazard.falling or not hazard.alive):
+                hazard.reset()
+                self.grid.update(hazard, hazard.bounds())
+                self.alive_bits[hazard.index // 8] |= 1 << (hazard.index % 8)
+            elif not alive and hazard.alive:
+                self.kill(hazard)
+        self.moving.clear()
+        for index, y, vy in falling:
+            hazard = self.hazards[index]
+            hazard.pos.y = y
+            hazard.vel.y = vy
+            self.wake(hazard)
+            self.grid.update(hazard, hazard.bounds())
+
+    def update(self, player):
+        #プレイヤーの少し先にある岩を落とし始める
+        ahead = (player.x, 0, player.x + ROCK_TRIGGER_DIST, self.world.height)
+        for hazard in self.grid.query(ahead):
+            #セル単位で拾った候補から、本当にプレイヤーの前ROCK_TRIGGER_DIST以内にある岩だけを落とす
+            if hazard.kind == "rock" and not hazard.falling and 0 <= hazard.pos.x - player.x <= ROCK_TRIGGER_DIST:
+                self.wake(hazard)
+
+        for hazard in list(self.moving):
+            hazard.update()
+            if hazard.pos.y > self.world.height:
+                self.kill(hazard)     #画面の下まで落ちたら消す
+            else:
+                self.grid.update(hazard, hazard.bounds())
+
+    def contacts(self, center, radius):
+        """円(center, radius)に触れているものを返す
+        Returns: [(hazard, 押し出す向き, めり込み量), ...]
+        """
+        area = (center.x - radius, center.y - radius, center.x + radius, center.y + radius)
+        found = []
+        for hazard in self.grid.query(area):
+            if hazard.shape == "circle":
+                hit = circle_vs_circle(center, radius, hazard.pos, hazard.radius)
+            else:
+                hit = circle_vs_rect(center, radius, hazard.bounds())
+            if hit:
+                found.append((hazard, hit[0], hit[1]))
+        return found
+
+    def draw(self, screen, scroll_x):
+        view = (scroll_x, 0, scroll_x + self.world.width, self.world.height)
+        for hazard in self.grid.query(view):
+            hazard.draw(screen, scroll_x)
+
+
+class RaySensor:
+    """ 天井とトゲまでの距離を測るレイセンサー（ボットやエイムアシスト用） """
+    def __init__(self, ceiling, spikes, rays=SENSOR_RAYS, spread=SENSOR_SPREAD, max_dist=SENSOR_RANGE):
+        self.ceiling = ceiling
+        self.spikes = spikes
+        self.max_dist = max_dist
+
+        #ROPE_ANGLEを中心に扇状にレイを並べる。方向と逆数は最初に一度だけ計算しておく
+        self.center_angle = ROPE_ANGLE
+        self.start_angle = ROPE_ANGLE - spread / 2 if rays > 1 else ROPE_ANGLE
+        self.step = spread / (rays - 1) if rays > 1 else 0
+        self.dirs = []
+        for i in range(rays):
+            d = pygame.Vector2(0, -1).rotate(self.start_angle + self.step * i)
+            inv_x = 1 / d.x if abs(d.x) > 1e-9 else None
+            inv_y = 1 / d.y if abs(d.y) > 1e-9 else None
+            self.dirs.append((d.x, d.y, inv_x, inv_y))
+
+    def _cast(self, ox, oy, blocks):
+        """1点からすべてのレイを飛ばす。blocksは見える範囲の天井ブロック
+        ブロックごとに見える角度の範囲を求めて、その範囲に入るレイだけ交差計算する
+        """
+        max_dist = self.max_dist
+        dirs = self.dirs
+        count = len(dirs)
+        ceiling_dists = [max_dist] * count
+        for rect in blocks:
+            left, right, top, bottom = rect.left, rect.right, rect.top, rect.bottom
+            if left <= ox <= right and top <= oy <= bottom:
+                #ブロックの中にいるときは全部0
+                ceiling_dists = [0.0] * count
+                break
+
+            #4つの角の角度（真上が0度、右回りが正）からレイの番号の範囲を出す
+            #扇の中心からの角度にして-180〜180度に収め、真後ろをまたいでも範囲がずれないようにする
+            angles = [(math.degrees(math.atan2(cx - ox, oy - cy)) - self.center_angle + 180) % 360 - 180
+                      for cx, cy in ((left, top), (right, top), (left, bottom), (right, bottom))]
+            lo = min(angles) + self.center_angle - self.start_angle
+            hi = max(angles) + self.center_angle - self.start_angle
+            if hi - lo > 180:
+                #扇の真後ろをまたいでいる（ブロックの外からは起きないが念のため）ので全部のレイを調べる
+                first, last = 0, count - 1
+            elif self.step:
+                first = max(0, math.ceil(lo / self.step))
+                last = min(count - 1, math.floor(hi / self.step))
+            else:
+                first, last = (0, 0) if lo <= 0 <= hi else (1, 0)
+
+            for i in range(first, last + 1):
+                dx, dy, inv_x, inv_y = dirs[i]
+                #スラブ法で交差距離を求める
+                if inv_x is None:
+                    t_near, t_far = 0.0, max_dist
+                else:
+                    t1 = (left - ox) * inv_x
+                    t2 = (right - ox) * inv_x
+                    t_near, t_far = (t1, t2) if t1 < t2 else (t2, t1)
+                if inv_y is not None:
+                    t1 = (top - oy) * inv_y
+                    t2 = (bottom - oy) * inv_y
+                    if t1 > t2:
+                        t1, t2 = t2, t1
+                    if t1 > t_near: t_near = t1
+                    if t2 < t_far: t_far = t2
+                if 0 <= t_near <= t_far and t_near < ceiling_dists[i]:
+                    ceiling_dists[i] = t_near
+
+        #トゲの床との交差（下向きのレイだけ当たる）
+        spike_y = self.spikes.y
+        spike_dists = []
+        for dx, dy, inv_x, inv_y in dirs:
+            if dy > 0:
+                t = (spike_y - oy) * inv_y
+                spike_dists.append(min(max(t, 0.0), max_dist))
+            else:
+                spike_dists.append(max_dist)
+        return ceiling_dists, spike_dists
+
+    def observe(self, pos):
+        """posから見た天井・トゲまでの距離を返す。当たらないレイはmax_dist
+        Returns: (ceiling_dists, spike_dists) どちらもレイの本数分のリスト
+        """
+        x, y = pos
+        blocks = self.ceiling.blocks_between(x - self.max_dist, x + self.max_dist)
+        return self._cast(x, y, blocks)
+
+    def observe_batch(self, positions):
+        """複数プレイヤー分をまとめて計算する。結果はpositionsと同じ順のリスト
+        プレイヤーをx順に並べ、見える範囲のブロックの窓を左から右へずらしていく
+        （重いのはレイの計算なので、かかる時間はobserveを人数分呼ぶのとほぼ同じ）
+        """
+        positions = [(p[0], p[1]) for p in positions]
+        blocks = self.ceiling.blocks
+        lefts = self.ceiling.lefts
+        rights = self.ceiling.rights
+        results = [None] * len(positions)
+        start = end = 0
+        for i in sorted(range(len(positions)), key=lambda i: positions[i][0]):
+            x, y = positions[i]
+            while start < len(rights) and rights[start] < x - self.max_dist:
+                start += 1
+            while end < len(lefts) and lefts[end] <= x + self.max_dist:
+                end += 1
+            results[i] = self._cast(x, y, blocks[start:end])
+        return results
+
+
+class RewindBuffer:
+    """ 毎フレームのゲーム状態を固定サイズのバイト列に詰めて保存するリングバッファ
+    オブジェクトはコピーせず、最初に確保したbytearrayに数値だけを書き込む
+    """
+    #プレイヤー(x, y, vx, vy), ロープ(有無, 支点x, 支点y, 長さ, グロー), スコア, 残り時間, スクロール, シェイク,
+    #乱数の版, エフェクト数, 落下中の岩の数
+    HEADER = struct.Struct("<13d3I")
+    #エフェクト1個分: 位置, 速度, 残り寿命, 寿命, 色(r, g, b), 大きさ
+    SPARK = struct.Struct("<10f")
+    #落下中の岩1個分: 通し番号, y, vy
+    FALLING = struct.Struct("<I2f")
+    #乱数の状態1個分: 版, メルセンヌ・ツイスタの内部状態(624語 + 位置), gaussの残りの有無, その値
+    RNG = struct.Struct("<I625I?d")
+
+    def __init__(self, memory_kb=REWIND_MEMORY_KB, max_effects=SNAPSHOT_MAX_EFFECTS,
+                 max_hazards=SNAPSHOT_MAX_HAZARDS, max_falling=SNAPSHOT_MAX_FALLING,
+                 max_rng_states=SNAPSHOT_MAX_RNG_STATES):
+        self.max_effects = max_effects
+        self.max_falling = max_falling
+        self.bits_size = (max_hazards + 7) // 8
+        self.slot_size = (self.HEADER.size + self.SPARK.size * max_effects
+                          + self.FALLING.size * max_falling + self.bits_size)
+        #乱数の状態は版ごとに「版 % max_rng_states」番目に上書きしていく（メモリの予算の1/4までを先に取る）
+        self.max_rng_states = max(1, min(max_rng_states, memory_kb * 1024 // 4 // self.RNG.size))
+        self.rng_buf = bytearray(self.RNG.size * self.max_rng_states)
+        self.capacity = max(1, (memory_kb * 1024 - len(self.rng_buf)) // self.slot_size)
+        self.buf = bytearray(self.slot_size * self.capacity)
+        self.clear()
+
+    def clear(self):
+        self.head = 0       #次に書き込む場所
+        self.count = 0      #保存されているフレーム数
+        self.rng_saved = None   #最後に状態を書き込んだ乱数の版
+        self.rng_buf[:] = bytes(len(self.rng_buf))
+
+    def capture(self, app):
+        """appの今の状態を1フレーム分書き込む"""
+        buf = self.buf
+        offset = self.head * self.slot_size
+        player = app.player
+        rope = app.rope
+        effects = app.effects[:self.max_effects]
+        falling = list(app.hazards.moving)[:self.max_falling]
+        if rope:
+            self.HEADER.pack_into(buf, offset, player.pos.x, player.pos.y, player.vel.x, player.vel.y,
+                                  1.0, rope.anchor.x, rope.anchor.y, rope.length, rope.glow_intensity,
+                                  app.score, app.time_remaining, app.scroll_x, app.shake_intensity,
+                                  app.rng_version, len(effects), len(falling))
+        else:
+            self.HEADER.pack_into(buf, offset, player.pos.x, player.pos.y, player.vel.x, player.vel.y,
+                                  0.0, 0.0, 0.0, 0.0, 0.0,
+                                  app.score, app.time_remaining, app.scroll_x, app.shake_intensity,
+                                  app.rng_version, len(effects), len(falling))
+        offset += self.HEADER.size
+        pack_spark = self.SPARK.pack_into
+        for e in effects:
+            r, g, b = e.color
+            pack_spark(buf, offset, e.pos.x, e.pos.y, e.vel.x, e.vel.y, e.life, e.max_life, r, g, b, e.size)
+            offset += self.SPARK.size
+        offset = self.head * self.slot_size + self.slot_size - self.bits_size - self.FALLING.size * self.max_falling
+        for hazard in falling:
+            self.FALLING.pack_into(buf, offset, hazard.index, hazard.pos.y, hazard.vel.y)
+            offset += self.FALLING.size
+        bits = app.hazards.alive_bits[:self.bits_size]
+        offset = (self.head + 1) * self.slot_size - self.bits_size
+        buf[offset:offset + len(bits)] = bits
+
+        #乱数はロープ接続時などにしか使わないので、版が変わったときだけ状態を書き込む
+        if app.rng_version != self.rng_saved:
+            _, internal, gauss_next = app.rng.getstate()
+            self.RNG.pack_into(self.rng_buf, (app.rng_version % self.max_rng_states) * self.RNG.size,
+                               app.rng_version, *internal, gauss_next is not None, gauss_next or 0.0)
+            self.rng_saved = app.rng_version
+
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _rng_state(self, version):
+        """版versionの乱数の状態を返す。もう上書きされていたらNone"""
+        values = self.RNG.unpack_from(self.rng_buf, (version % self.max_rng_states) * self.RNG.size)
+        if values[0] != version:
+            return None
+        return (3, values[1:626], values[627] if values[626] else None)
+
+    def rewind(self, app, frames):
+        """framesフレーム前の状態をappに戻す。戻した先より新しいスナップショットは捨てる
+        Returns: 戻せたらTrue
+        """
+        if self.count == 0:
+            return False
+        steps = max(0, min(frames, self.count - 1))
+        #乱数の状態が残っているところまでしか戻れない（一番新しいフレームの分は必ず残っている）
+        while True:
+            index = (self.head - 1 - steps) % self.capacity
+            offset = index * self.slot_size
+            (px, py, vx, vy, has_rope, ax, ay, length, glow,
+             score, time_remaining, scroll_x, shake, rng_version, n_effects, n_falling) = self.HEADER.unpack_from(self.buf, offset)
+            rng_state = self._rng_state(rng_version)
+            if rng_state is not None or steps == 0:
+                break
+            steps -= 1
+
+        player = app.player
+        player.pos.update(px, py)
+        player.vel.update(vx, vy)
+        if has_rope:
+            app.rope = Rope(ax, ay, player, app.world)
+            app.rope.length = length
+            app.rope.glow_intensity = glow
+        else:
+            app.rope = None
+        app.score = int(score)
+        app.time_remaining = time_remaining
+        app.scroll_x = scroll_x
+        app.shake_intensity = shake
+        app.rng_version = rng_version
+        app.rng.setstate(rng_state)
+        self.rng_saved = rng_version
+
+        app.effects.clear()
+        offset += self.HEADER.size
+        for _ in range(n_effects):
+            x, y, evx, evy, life, max_life, r, g, b, size = self.SPARK.unpack_from(self.buf, offset)
+            spark = Spark((x, y), (evx, evy), life=int(life), color=(int(r), int(g), int(b)), size=int(size))
+            spark.max_life = int(max_life)
+            app.effects.append(spark)
+            offset += self.SPARK.size
+
+        offset = (index + 1) * self.slot_size - self.bits_size - self.FALLING.size * self.max_falling
+        falling = [self.FALLING.unpack_from(self.buf, offset + self.FALLING.size * i) for i in range(n_falling)]
+        offset = (index + 1) * self.slot_size - self.bits_size
+        app.hazards.restore(self.buf[offset:offset + self.bits_size], falling)
+
+        self.head = (index + 1) % self.capacity
+        self.count -= steps
+        return True
+
+
+class FrameRecorder:
+    """ 描画したフレームを別スレッドで書き出す録画機能
+    フレームは使い回しのSurfaceにコピーするだけで、空きがなければ捨てる（ゲームループは止めない）
+    out_dirを渡すと連番画像、commandを渡すとその標準入力に生のRGBを流す
+    """
+    def __init__(self, screen, out_dir=None, command=None, image_format="png", pool_size=CAPTURE_POOL_SIZE):
+        self.out_dir = out_dir
+        self.image_format = image_format
+        self.frames = 0         #キャプチャしようとしたフレーム数
+        self.dropped = 0        #バッファに空きがなくて捨てたフレーム数（ゲームのスレッドだけが数える）
+        self.written = 0        #書き出したフレーム数（連番もこれで振るので欠番はない）
+        self.failed = 0         #書き出しに失敗したフレーム数（書き出しスレッドだけが数える）
+
+        self.free = queue.Queue()
+        for _ in range(pool_size):
+            self.free.put(screen.copy())
+        self.pending = queue.Queue(maxsize=pool_size)
+
+        self.process = None
+        if command:
+            #例: ffmpeg -f rawvideo -pix_fmt rgb24 -s 800x600 -r 60 -i - out.mp4
+            self.process = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE)
+        elif out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def capture(self, screen):
+        """今のscreenをバッファにコピーして書き出し待ちに入れる"""
+        self.frames += 1
+        try:
+            surface = self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return
+        surface.blit(screen, (0, 0))
+        self.pending.put_nowait(surface)
+
+    def _worker(self):
+        while True:
+            surface = self.pending.get()
+            if surface is None:
+                return
+            try:
+                if self.process:
+                    self.process.stdin.write(pygame.image.tobytes(surface, "RGB"))
+                else:
+                    #ffmpegの -i frame_%06d.png で読めるように、書き出せたフレームだけで連番にする
+                    path = os.path.join(self.out_dir, f"frame_{self.written:06d}.{self.image_format}")
+                    pygame.image.save(surface, path)
+                self.written += 1
+            except (OSError, ValueError, pygame.error):
+                #エンコーダが終了していたり、保存先がなくなっていたら、そのフレームは捨てる
+                self.failed += 1
+            finally:
+                self.free.put(surface)
+
+    def close(self):
+        """書き出し待ちのフレームを全部書いてから終了する"""
+        #書き出しスレッドが生きている間だけ終了の合図を送る（止まっていたら待ち続けない）
+        while self.thread.is_alive():
+            try:
+                self.pending.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+        if self.process:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            self.process.wait()
+
+
+def estimate_swing_reach(launch_h, world=None, max_ticks=120):
+    """高さlaunch_hのブロックの端にロープをかけたとき、次のブロックにどこまで先でロープを刺せるかを見積もる
+    最高速度(10)で右に進みながらロープを発射してブーストし、一番いいタイミングで離したときの
+    「次のロープの狙い位置 - 支点のx」を、次のブロックの高さ(50〜200)ごとの辞書で返す
+    fire_ropeと同じく、次のブロックの下端より下にいるときだけ刺せるとみなす（今のKICK_STRENGTH・GRAVITY・AIR_DRAGで計算）
+    """
+    if world is None:
+        world = World(800, 600, gravity=GRAVITY)
+    spikes = SpikeFloor(world)
+    aim_vec = pygame.Vector2(0, -1).rotate(ROPE_ANGLE)
+    aim_dx = aim_vec.x * 100 / abs(aim_vec.y)     #get_rope_targetと同じく100px上を狙う
+
+    #100px下から支点(0, launch_h)にロープを刺した直後の状態を作る
+    player = Particle(-aim_dx, launch_h + 100, world)
+    rope = Rope(0, launch_h, player, world)
+    player.vel = pygame.Vector2(10, 0)
+    normal = (rope.anchor - player.pos).normalize()
+    tangent = normal.rotate(90)
+    if tangent.x < 0:
+        tangent = -tangent
+    player.vel += tangent * KICK_STRENGTH
+
+    #離すタイミングごとに飛んだ軌道の点 (y, 狙い位置) を集める
+    points = []
+    for _ in range(max_ticks):
+        player.update()
+        rope.update()
+        flyer = Particle(player.x, player.y, world)
+        flyer.vel = pygame.Vector2(player.vel)
+        for _ in range(max_ticks):
+            #トゲに当たるか、もう前に進まなくなったら終わり
+            if spikes.check_hit(flyer) or flyer.vx < 0.01:
+                break
+            points.append((flyer.y, flyer.x + aim_dx))
+            flyer.update()
+
+    #下の点から順に見ていき、次のブロックの高さより下にある点の狙い位置の最大を取る
+    points.sort(reverse=True)
+    reach = {}
+    best = 0.0
+    i = 0
+    for land_h in range(200, 49, -1):
+        while i < len(points) and points[i][0] > land_h:
+            best = max(best, points[i][1])
+            i += 1
+        reach[land_h] = best
+    return reach
+
+
+def percentile(sorted_values, p):
+    """ソート済みリストのpパーセンタイル（最近傍法）"""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def run_course_analytics(count, seed=0, out_path="course_report.json"):
+    """seed, seed+1, ... のコースをまとめて生成して、難易度の統計をJSONに書き出す"""
+    started = time.perf_counter()
+    world = World(800, 600, gravity=GRAVITY)
+    #(発射側の高さ, 着地側の高さ)ごとの届く距離を先に計算しておく（コースごとには計算しない）
+    #一番低い天井と一番高い天井から撃って結果が同じなら、発射側の高さには関係ないとみなして使い回す
+    lowest = estimate_swing_reach(200, world)
+    highest = estimate_swing_reach(50, world)
+    if lowest == highest:
+        reach_by_launch = {h: highest for h in range(50, 201)}
+    else:
+        reach_by_launch = {h: estimate_swing_reach(h, world) for h in range(50, 201)}
+
+    all_gaps = []
+    all_widths = []
+    all_heights = []
+    max_gaps = []
+    uncrossable_counts = []
+    rng = random.Random()
+    for i in range(count):
+        rng.seed(seed + i)
+        course = generate_course(rng)
+        uncrossable = 0
+        gaps = []
+        #スタート地点の天井と最初のブロックはくっついている(隙間0)ので、最初のブロックから数える
+        first_x, first_w, first_h = course[1]
+        all_widths.append(first_w)
+        all_heights.append(first_h)
+        prev_right, prev_h = first_x + first_w, first_h
+        for x, w, h in course[2:]:
+            gap = x - prev_right
+            gaps.append(gap)
+            #支点をブロックの右端にとったときに次のブロックまで届くか
+            if gap > reach_by_launch[prev_h][h]:
+                uncrossable += 1
+            all_widths.append(w)
+            all_heights.append(h)
+            prev_right, prev_h = x + w, h
+        all_gaps.extend(gaps)
+        max_gaps.append(max(gaps))
+        uncrossable_counts.append(uncrossable)
+    crossable_courses = uncrossable_counts.count(0)
+
+    all_gaps.sort()
+    max_gaps.sort()
+    report = {
+        "courses": count,
+        "seed": seed,
+        "settings": {"ROPE_ANGLE": ROPE_ANGLE, "KICK_STRENGTH": KICK_STRENGTH,
+                     "GRAVITY": GRAVITY, "AIR_DRAG": AIR_DRAG},
+        "blocks_per_course": len(all_widths) / count + 1 if count else 0,
+        "gap": {"min": all_gaps[0] if all_gaps else None, "max": all_gaps[-1] if all_gaps else None,
+                "mean": sum(all_gaps) / len(all_gaps) if all_gaps else None,
+                "p50": percentile(all_gaps, 50), "p90": percentile(all_gaps, 90),
+                "p99": percentile(all_gaps, 99)},
+        "max_gap_per_course": {"p50": percentile(max_gaps, 50), "p90": percentile(max_gaps, 90),
+                               "p99": percentile(max_gaps, 99), "max": max_gaps[-1] if max_gaps else None},
+        "block_width_mean": sum(all_widths) / len(all_widths) if all_widths else None,
+        "block_height_mean": sum(all_heights) / len(all_heights) if all_heights else None,
+        "swing_reach": {"min": min(min(r.values()) for r in reach_by_launch.values()),
+                        "max": max(max(r.values()) for r in reach_by_launch.values()),
+                        "depends_on_launch_height": lowest != highest},
+        "uncrossable_gap_rate": sum(uncrossable_counts) / len(all_gaps) if all_gaps else None,
+        "crossable_course_rate": crossable_courses / count if count else None,
+        "worst_courses": sorted(range(count), key=lambda i: -uncrossable_counts[i])[:10],
+        "elapsed_sec": time.perf_counter() - started,
+    }
+    report["worst_courses"] = [{"seed": seed + i, "uncrossable_gaps": uncrossable_counts[i]}
+                               for i in report["worst_courses"]]
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def run_benchmarks(ticks=600):
+    """1フレームの処理時間と、追加機能の1回あたりのコストを測る"""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")     #ウィンドウを出さずに測る
+    app = AppMain()
+    app.reset_game()
+
+    started = time.perf_counter()
+    for _ in range(ticks):
+        if app.state != "PLAYING":
+            app.reset_game()
+        app.update()
+        app.draw()
+    tick_ms = (time.perf_counter() - started) / ticks * 1000
+
+    started = time.perf_counter()
+    for _ in range(ticks):
+        app.rewind.capture(app)
+    snapshot_ms = (time.perf_counter() - started) / ticks * 1000
+
+    #録画のメインスレッド側のコスト（コピーとキューへの追加だけ）
+    out_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_capture")
+    recorder = FrameRecorder(app.screen, out_dir, image_format="tga")
+    spent = 0.0
+    for _ in range(ticks):
+        started = time.perf_counter()
+        recorder.capture(app.screen)
+        spent += time.perf_counter() - started
+        app.clock.tick(60)
+    capture_ms = spent / ticks * 1000
+    recorder.close()
+    for name in os.listdir(out_dir):
+        os.remove(os.path.join(out_dir, name))
+    os.rmdir(out_dir)
+
+    #256点の軌跡（点の追加込み）と、同じ256点をdraw.linesで1回描くのを比べる
+    trail = MotionTrail(256)
+    path = [(app.scroll_x + 100 + i * 2.5, 300 + 50 * math.sin(i / 20)) for i in range(ticks + 256)]
+    for x, y in path[:256]:
+        trail.push(x, y)
+    started = time.perf_counter()
+    for x, y in path[256:]:
+        trail.push(x, y)
+        trail.draw(app.screen, x - 400)
+    trail_ms = (time.perf_counter() - started) / ticks * 1000
+    points = [(x - app.scroll_x, y) for x, y in path[:256]]
+    started = time.perf_counter()
+    for _ in range(ticks):
+        pygame.draw.lines(app.screen, (255, 240, 200), False, points, 6)
+    lines_ms = (time.perf_counter() - started) / ticks * 1000
+
+    results = {
+        "tick_ms": tick_ms,
+        "trail_ms": trail_ms,
+        "lines_ms": lines_ms,
+        "capture_frames": recorder.frames,
+        "capture_dropped": recorder.dropped,
+        "snapshot_ms": snapshot_ms,
+        "capture_ms": capture_ms,
+        "snapshot_bytes": app.rewind.slot_size,
+        "rewind_frames": app.rewind.capacity,
+    }
+    pygame.quit()
+    return results
+
+
 class AppMain:
-    def __init__(self):
+    def __init__(self, record_dir=None, record_cmd=None, record_format="png", measure_latency=False,
+                 trail_length=TRAIL_LENGTH):
         pygame.init()
         self.world = World(800, 600, gravity=GRAVITY)
         self.screen = pygame.display.set_mode((self.world.width, self.world.height))
+        self.recorder = None
+        if record_dir or record_cmd:
+            self.recorder = FrameRecorder(self.screen, record_dir, record_cmd, record_format)
         self.clock = pygame.time.Clock()
         self.font = pygame.font.SysFont(None, 60)       #フォントを用意
         self.font_small = pygame.font.SysFont(None, 24)
@@ -224,13 +1116,26 @@ class AppMain:
         self.paused = False
         self.time_remaining = TIME_LIMIT  #残り時間
         self.shake_intensity = 0  # スクリーンシェイク用
-        self.prev_player_pos = None  # トレイル生成用
+        self.trail = MotionTrail(trail_length)  # プレイヤーの軌跡
+        self.rng = random.Random()   # エフェクト用の乱数（巻き戻しで状態を戻せるように分けておく）
+        self.rng_version = 0         # rngを使うたびに増やす
+        self.rewind = RewindBuffer()
+        self.running = True
+        self.mouse_held = False      # イベントから追いかけた左ボタンの状態
+        self.input_events = []       # (押した/離した時刻, "down" or "up")
+        self.frame_start = time.perf_counter()
+        self.last_update_time = self.frame_start
+        self.measure_latency = measure_latency
+        self.latency_pending = []    # まだ画面に出ていない入力の時刻
+        self.latency_samples = collections.deque(maxlen=120)  # 入力から画面表示までの時間（秒）
         self.reset_game()       #ゲームオーバー後の再スタートに使えるように関数で用意
         self.state = "READY" #クリックでスタートするので、ゲーム開始前の状態を用意
 
     def reset_game(self):
         self.ceiling = CeilingMap(self.world)
         self.spikes = SpikeFloor(self.world)
+        self.sensor = RaySensor(self.ceiling, self.spikes)
+        self.hazards = CollisionWorld.from_ceiling(self.world, self.ceiling)
 
         #スタート地点の天井の高さを調べる
         start_x = 200
@@ -247,7 +1152,16 @@ class AppMain:
         self.score = 0
         self.time_remaining = TIME_LIMIT  #残り時間をリセット
         self.shake_intensity = 0
-        self.prev_player_pos = pygame.Vector2(self.player.x, self.player.y)
+        self.trail.clear()
+        self.rewind.clear()
+
+    def rewind_game(self, seconds=REWIND_SECONDS):
+        """数秒前の状態に巻き戻す。ゲームオーバー直後ならそこから再開できる"""
+        if self.state not in ("PLAYING", "GAMEOVER"):
+            return
+        if self.rewind.rewind(self, int(seconds * 60)):
+            self.state = "PLAYING"
+            self.trail.clear()      #軌跡は見た目だけなので、巻き戻したら描き直す
 
     def get_rope_target(self):
         start_y = self.player.y - 100    #とりあえず高さ100px上を基準にしてみる
@@ -265,7 +1179,60 @@ class AppMain:
         
         target_x = self.player.x + dx
         return target_x
-            
+
+    def fire_rope(self):
+        """狙った場所に天井があればロープをかけてブーストする"""
+        #狙う場所を計算(斜め50度)
+        target_x = self.get_rope_target()
+        ceil_y = self.ceiling.get_ceiling_y(target_x)
+
+        #天井があるかつ自分より上にあったら発射成功
+        if ceil_y is None or ceil_y >= self.player.y:
+            return
+        self.rope = Rope(target_x, ceil_y, self.player, self.world)
+
+        #加速させる(接線方向に力を加える)
+        rope_vec = self.rope.anchor - self.player.pos   #プレイヤーから支点へのベクトル
+
+        if rope_vec.length() > 0:
+            normal = rope_vec.normalize()    #ロープ方向の単位ベクトル
+            tangent = normal.rotate(90)  #接線方向の単位ベクトル
+
+            if tangent.x < 0:
+                tangent =- tangent   #右向きにブーストしたいので、x成分が正になるようにする
+
+            self.player.vel += tangent * KICK_STRENGTH
+
+        # 接続時のエフェクト
+        self.shake_intensity = 2.0
+        for i in range(8):
+            vel = pygame.Vector2(self.rng.uniform(-2, 2), self.rng.uniform(-3, -1))
+            self.effects.append(Spark(self.rope.anchor, vel, life=20, color=(255, 200, 100), size=3))
+        self.rng_version += 1
+
+    def advance(self, dt):
+        """物理演算をdtフレーム分だけ進める（1フレームの途中で入力があったときは分割して呼ぶ）"""
+        if dt <= 0:
+            return
+        self.world.dt = dt
+        self.player.update()
+        if self.rope:
+            self.rope.update()
+        self.world.dt = 1.0
+
+    def take_input_events(self):
+        """前回のupdateから今までの入力を (フレーム内の位置0〜1, 種類, 時刻) で返す"""
+        now = time.perf_counter()
+        span = now - self.last_update_time
+        events = []
+        for stamp, kind in self.input_events:
+            frac = (stamp - self.last_update_time) / span if span > 0 else 1.0
+            events.append((min(max(frac, 0.0), 1.0), kind, stamp))
+        self.input_events.clear()
+        self.last_update_time = now
+        if self.measure_latency:
+            self.latency_pending.extend(stamp for _, _, stamp in events)
+        return events
 
     def update(self):
         #ESCキーで終了
@@ -273,64 +1240,57 @@ class AppMain:
         if key_pressed[pygame.K_ESCAPE]:
             pygame.event.post(pygame.event.Event(pygame.QUIT))
 
+        #前回のupdateからの入力（押した時刻つき）
+        events = self.take_input_events()
+        clicked = any(kind == "down" for _, kind, _ in events)
+
         # ポーズは run() の KEYDOWN でトグルされる
         if self.paused:
+            for _, kind, _ in events:
+                self.mouse_held = kind == "down"
             return
 
         #READY状態のとき、クリックされたらPLAYINGに変える
         if self.state == "READY":
-            if pygame.mouse.get_pressed()[0]:
+            if clicked or self.mouse_held:
                 self.state = "PLAYING"
+            for _, kind, _ in events:
+                self.mouse_held = kind == "down"
             return
 
         #GAMEOVERまたはGOALのときのリスタート処理
+        #押しっぱなしのまま死んだときにすぐリスタートしないよう、新しく押したときだけ（Rで巻き戻せるように）
         if self.state == "GAMEOVER" or self.state == "GOAL":
-            if pygame.mouse.get_pressed()[0]:
+            if clicked:
                 self.reset_game()
+            for _, kind, _ in events:
+                self.mouse_held = kind == "down"
             return
 
-        #入力処理
-        mouse_pressed = pygame.mouse.get_pressed()[0]
-        
-        if mouse_pressed:
-            #クリックしていて、ロープがまだない場合
-            if self.rope is None:
-                #狙う場所を計算(斜め50度)
-                target_x = self.get_rope_target()
-                ceil_y = self.ceiling.get_ceiling_y(target_x)
-                
-                #天井があるかつ自分より上にあったら発射成功
-                if ceil_y is not None and ceil_y < self.player.y:
-                    self.rope = Rope(target_x, ceil_y, self.player, self.world)
-                    
-                    #加速させる(接線方向に力を加える)
-                    rope_vec = self.rope.anchor - self.player.pos   #プレイヤーから支点へのベクトル
-
-                    if rope_vec.length() > 0:
-                        normal = rope_vec.normalize()    #ロープ方向の単位ベクトル
-                        tangent = normal.rotate(90)  #接線方向の単位ベクトル
-
-                        if tangent.x < 0:
-                            tangent =- tangent   #右向きにブーストしたいので、x成分が正になるようにする
-
-                        self.player.vel += tangent * KICK_STRENGTH
-                    
-                    # 接続時のエフェクト
-                    self.shake_intensity = 2.0
-                    for i in range(8):
-                        vel = pygame.Vector2(random.uniform(-2, 2), random.uniform(-3, -1))
-                        self.effects.append(Spark(self.rope.anchor, vel, life=20, color=(255, 200, 100), size=3))
-
-        else:
-            #マウスを離したらロープ解除
+        #入力処理と物理演算
+        #押した・離した時刻でフレームを区切り、その瞬間の位置でロープをかける・外す
+        #（1フレームの中で押して離しても、ロープをかけたブーストは残る）
+        done = 0.0
+        for frac, kind, _ in events:
+            self.advance(frac - done)
+            done = max(done, frac)
+            if kind == "down":
+                self.mouse_held = True
+                if self.rope is None:
+                    self.fire_rope()
+            else:
+                #マウスを離したらロープ解除
+                self.mouse_held = False
+                self.rope = None
+
+        #押しっぱなしで、狙った先に天井が来たら発射する。押していなければロープはなし
+        if self.mouse_held and self.rope is None:
+            self.fire_rope()
+        elif not self.mouse_held:
             self.rope = None
+        self.advance(1.0 - done)
 
-        #物理演算
-        self.player.update()
-        if self.rope:
-            self.rope.update()
-        
-        self.prev_player_pos = pygame.Vector2(self.player.x, self.player.y)
+        self.trail.push(self.player.x, self.player.y)
         
         # スクリーンシェイクを減衰
         self.shake_intensity *= 0.9
@@ -355,6 +1315,20 @@ class AppMain:
                 self.player.x = rect.right + self.player.radius
                 self.player.vx = 0
 
+        # 落石・アイテムとの当たり判定
+        self.hazards.update(self.player)
+        for hazard, normal, depth in self.hazards.contacts(self.player.pos, self.player.radius):
+            if hazard.kind == "pickup":
+                self.hazards.kill(hazard)
+                self.time_remaining += PICKUP_TIME_BONUS
+                for i in range(8):
+                    vel = pygame.Vector2(self.rng.uniform(-2, 2), self.rng.uniform(-2, 2))
+                    self.effects.append(Spark(hazard.pos, vel, life=20, color=(255, 215, 0), size=3))
+                self.rng_version += 1
+            elif hazard.kind == "rock":
+                self.shake_intensity = 5.0
+                self.state = "GAMEOVER"
+
         # エフェクト更新
         for e in list(self.effects):
             e.update()
@@ -387,6 +1361,9 @@ class AppMain:
         if self.player.x > GOAL_X:
             self.state = "GOAL"
 
+        #巻き戻し用に今のフレームを保存
+        self.rewind.capture(self)
+
     def draw(self):
         # 背景
         self.screen.fill((100, 180, 255))
@@ -401,6 +1378,7 @@ class AppMain:
         
         self.ceiling.draw(self.screen, effective_scroll)
         self.spikes.draw(self.screen, effective_scroll)
+        self.hazards.draw(self.screen, effective_scroll)
 
         #ゴールラインの描画
         # ゴールを点滅させて目立たせる
@@ -435,6 +1413,7 @@ class AppMain:
             pygame.draw.line(self.screen, color, start_pos, end_pos, 2)
 
         #プレイヤーとロープを表示
+        self.trail.draw(self.screen, effective_scroll)
         if self.rope:
             self.rope.draw(self.screen, effective_scroll)
         self.player.draw(self.screen, effective_scroll)
@@ -459,29 +1438,112 @@ class AppMain:
         elif self.state == "GAMEOVER":
             msg = self.font.render("GAME OVER", True, (255, 100, 100))
             self.screen.blit(msg, (self.world.width/2 - 150, self.world.height/2))
-            retry = self.font_small.render("Click to retry", True, (255, 255, 255))
+            retry = self.font_small.render("Click to retry / R to rewind", True, (255, 255, 255))
             self.screen.blit(retry, (self.world.width/2 - 80, self.world.height/2 + 50))
         elif self.state == "GOAL":
             msg = self.font.render("GOAL!!", True, (255, 255, 100))
             self.screen.blit(msg, (self.world.width/2 - 150, self.world.height/2))
             retry = self.font_small.render("Click to play again", True, (255, 255, 255))
             self.screen.blit(retry, (self.world.width/2 - 100, self.world.height/2 + 50))
-        
+
+        # 入力遅延の表示
+        if self.measure_latency and self.latency_samples:
+            samples = [t * 1000 for t in self.latency_samples]
+            latency_text = self.font_small.render(
+                f"Latency: {sum(samples) / len(samples):.1f} ms (max {max(samples):.1f})", True, (255, 255, 255))
+            self.screen.blit(latency_text, (10, 60))
+
+        #録画中ならフレームを渡す（書き出しは別スレッド）
+        if self.recorder:
+            self.recorder.capture(self.screen)
+
         pygame.display.update()
 
+        #入力が反映されたフレームを表示し終わった時点で、遅延を記録する
+        if self.latency_pending:
+            shown = time.perf_counter()
+            self.latency_samples.extend(shown - stamp for stamp in self.latency_pending)
+            self.latency_pending.clear()
+
     def run(self):
-        while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    return
-                if event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_p:
-                        self.paused = not self.paused
-                    if event.key == pygame.K_ESCAPE:
-                        pygame.event.post(pygame.event.Event(pygame.QUIT))
+        try:
+            self.loop()
+        finally:
+            if self.recorder:
+                self.recorder.close()
+                print(f"recorded {self.recorder.written} frames, dropped {self.recorder.dropped} (buffers full), "
+                      f"failed {self.recorder.failed} (encoder errors)")
+            if self.measure_latency and self.latency_samples:
+                samples = sorted(t * 1000 for t in self.latency_samples)
+                print(f"input-to-display latency: avg {sum(samples) / len(samples):.1f} ms, "
+                      f"p50 {percentile(samples, 50):.1f} ms, max {samples[-1]:.1f} ms")
+
+    def poll_events(self):
+        """イベントを処理する。マウスの左ボタンは押した時刻をつけてupdateに渡す"""
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.running = False
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_p:
+                    self.paused = not self.paused
+                if event.key == pygame.K_r:
+                    self.rewind_game()
+                if event.key == pygame.K_ESCAPE:
+                    pygame.event.post(pygame.event.Event(pygame.QUIT))
+            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                self.input_events.append((time.perf_counter(), "down"))
+            if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+                self.input_events.append((time.perf_counter(), "up"))
+
+    def wait_for_next_frame(self):
+        """次のフレームまで、1msごとにイベントを拾いながら待つ（入力の時刻をフレームより細かく取るため）"""
+        deadline = self.frame_start + 1 / 60
+        while self.running:
+            self.poll_events()
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            time.sleep(min(0.001, deadline - now))
+        #処理落ちしたときは、遅れを取り戻そうとせずそこから数え直す
+        self.frame_start = max(deadline, time.perf_counter() - 1 / 60)
+        self.clock.tick()
+
+    def loop(self):
+        while self.running:
+            self.poll_events()
             self.update()
             self.draw()
-            self.clock.tick(60)
+            self.wait_for_next_frame()
 
 if __name__ == "__main__":
-    AppMain().run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="ターザンロープアクションゲーム")
+    sub = parser.add_subparsers(dest="command")
+    analyze = sub.add_parser("analyze", help="たくさんのコースを生成して難易度を集計する")
+    analyze.add_argument("--courses", type=int, default=100000)
+    analyze.add_argument("--seed", type=int, default=0)
+    analyze.add_argument("--out", default="course_report.json")
+    bench = sub.add_parser("bench", help="1フレームの処理時間と追加機能のコストを測る")
+    bench.add_argument("--ticks", type=int, default=600)
+    parser.add_argument("--record", metavar="DIR", help="プレイ画面を連番画像としてDIRに録画する")
+    parser.add_argument("--record-format", default="png", help="連番画像の形式（png, tga, bmp, jpg）")
+    parser.add_argument("--record-pipe", metavar="CMD", help="生のRGBフレームをCMDの標準入力に流す（例: ffmpeg）")
+    parser.add_argument("--latency", action="store_true", help="クリックから画面表示までの遅延を測って表示する")
+    parser.add_argument("--trail", type=int, default=TRAIL_LENGTH, help="プレイヤーの軌跡の長さ（0で表示しない）")
+    args = parser.parse_args()
+
+    if args.command == "analyze":
+        report = run_course_analytics(args.courses, args.seed, args.out)
+        print(f"{report['courses']} courses in {report['elapsed_sec']:.1f}s -> {args.out}")
+        print(f"gap p50/p90/p99: {report['gap']['p50']}/{report['gap']['p90']}/{report['gap']['p99']}"
+              f"  crossable courses: {report['crossable_course_rate']:.1%}")
+    elif args.command == "bench":
+        results = run_benchmarks(args.ticks)
+        print(f"tick: {results['tick_ms']:.3f} ms")
+        print(f"snapshot: {results['snapshot_ms']:.4f} ms ({results['snapshot_ms'] / results['tick_ms']:.1%} of a tick), "
+              f"{results['snapshot_bytes']} bytes/frame, {results['rewind_frames'] / 60:.1f} s of rewind")
+        print(f"capture at 60 fps: {results['capture_ms']:.3f} ms/frame on the game thread, "
+              f"dropped {results['capture_dropped']}/{results['capture_frames']}")
+        print(f"trail (256 points, push + draw): {results['trail_ms']:.3f} ms, "
+              f"one draw.lines of the same points: {results['lines_ms']:.3f} ms")
+    else:
+        AppMain(args.record, args.record_pipe, args.record_format, args.latency, args.trail).run()
\ No newline at end of file